@@ -1,14 +1,34 @@
 import streamlit as st
-from vector_rag.chunking import LineChunker, SizeChunker, debug_chunker
+from vector_rag.chunking import LineChunker, SizeChunker
 from vector_rag.db import DBFileHandler
-from vector_rag.model import File
+from vector_rag.model import Chunk, ChunkResult, ChunkResults, File
 from vector_rag.config import Config
 from vector_rag.embeddings import OpenAIEmbedder
+from pgvector.sqlalchemy import HALFVEC
+from sqlalchemy import (Float, Integer, any_, bindparam, cast, delete, func, literal,
+                        literal_column, select, text)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.exc import DBAPIError, IntegrityError
+try:
+    from sqlalchemy.dialects.postgresql import distinct_on
+except ImportError:  # SQLAlchemy < 2.1
+    distinct_on = None
+import numpy as np
+import pandas as pd
+import httpx
+import openai
+import xxhash
+import asyncio
+import concurrent.futures
+import math
+import random
 import tempfile
+import threading
+import weakref
 import os
-import hashlib
 import logging
-from typing import Optional
+from pathlib import Path
+from typing import List, Optional
 
 # Configure logging
 logging.basicConfig(
@@ -17,6 +37,329 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# OpenAI accepts at most 2048 inputs per embeddings request
+OPENAI_MAX_BATCH_SIZE = 2048
+EMBED_BATCH_SIZE = min(int(os.getenv('EMBED_BATCH_SIZE', 16)), OPENAI_MAX_BATCH_SIZE)
+# Number of embedding requests allowed in flight at once
+EMBED_CONCURRENCY = int(os.getenv('EMBED_CONCURRENCY', 4))
+EMBED_MAX_RETRIES = int(os.getenv('EMBED_MAX_RETRIES', 5))
+# Per-request HTTP timeout; the wait for a whole embed_batches call is
+# derived from it, the retry budget and the number of batches
+EMBED_REQUEST_TIMEOUT = float(os.getenv('EMBED_REQUEST_TIMEOUT', 30))
+EMBED_MAX_BACKOFF = 30.0
+# Oldest pgvector extension with the features used below
+# (halfvec needs 0.7, hnsw.iterative_scan needs 0.8)
+PGVECTOR_MIN_VERSION = "0.8.0"
+# HNSW build parameters and search-time candidate list size
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', 40))
+# Nearest neighbours fetched from the index before dedup, threshold and paging
+SEARCH_CANDIDATES = int(os.getenv('SEARCH_CANDIDATES', 200))
+# Brute-force NumPy search over a per-project embedding matrix; above
+# DENSE_SEARCH_MAX_CHUNKS the HNSW index is faster
+DENSE_SEARCH = os.getenv('DENSE_SEARCH', 'true').lower() == 'true'
+DENSE_SEARCH_MAX_CHUNKS = int(os.getenv('DENSE_SEARCH_MAX_CHUNKS', 100_000))
+# Opt-in: delete duplicate files (same content in one project) at startup so
+# the unique crc index can be created
+DEDUPE_FILES_ON_START = os.getenv('DEDUPE_FILES_ON_START', 'false').lower() == 'true'
+DENSE_INDEX_DIR = Path(
+    os.getenv('DENSE_INDEX_DIR', Path(__file__).resolve().parent.parent / '.dense_index')
+).resolve()
+
+def _stop_embedder_loop(loop: asyncio.AbstractEventLoop, thread: threading.Thread,
+                        client: openai.AsyncOpenAI) -> None:
+    if loop.is_closed():
+        return
+    try:
+        # Close pooled connections on the loop that opened them
+        asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout=5)
+    except Exception as e:
+        logger.warning(f"Error closing embedding client: {str(e)}")
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(timeout=5)
+    if not thread.is_alive():
+        loop.close()
+
+class BatchEmbedder(OpenAIEmbedder):
+    """OpenAI embedder that sends texts in concurrent batches over one
+    long-lived HTTP/2 connection."""
+
+    def __init__(self, config: Optional[Config] = None, batch_size: int = 16):
+        super().__init__(config, batch_size=batch_size)
+        # The async client is bound to the loop it runs on, so it gets a loop
+        # of its own that lives as long as the embedder (and the cached
+        # handler holding it). Connections then outlive any single upload.
+        self._loop = asyncio.new_event_loop()
+        thread = threading.Thread(
+            target=self._loop.run_forever, name="embedder-loop", daemon=True
+        )
+        thread.start()
+        self.async_client = openai.AsyncOpenAI(
+            api_key=self.client.api_key,
+            max_retries=0,  # retried per batch in _embed_with_retry
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=10, max_connections=10),
+                timeout=EMBED_REQUEST_TIMEOUT,
+            ),
+        )
+        # Stop the loop when the embedder is collected (e.g. the cached handler
+        # is rebuilt), on close(), or at interpreter exit
+        self._finalizer = weakref.finalize(
+            self, _stop_embedder_loop, self._loop, thread, self.async_client
+        )
+
+    def close(self) -> None:
+        self._finalizer()
+
+    def embed_batches(self, texts: List[str]) -> List[List[float]]:
+        future = asyncio.run_coroutine_threadsafe(
+            self.embed_batches_async(texts), self._loop
+        )
+        # Batches run EMBED_CONCURRENCY at a time; each may use every retry
+        rounds = math.ceil(math.ceil(len(texts) / EMBED_BATCH_SIZE) / EMBED_CONCURRENCY)
+        timeout = max(rounds, 1) * (EMBED_MAX_RETRIES + 1) * (EMBED_REQUEST_TIMEOUT + EMBED_MAX_BACKOFF)
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"Embedding {len(texts)} texts took longer than {timeout:.0f}s")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_batches([text])[0]
+
+    async def embed_batches_async(self, texts: List[str]) -> List[List[float]]:
+        """Embed texts in EMBED_BATCH_SIZE batches with up to EMBED_CONCURRENCY
+        requests in flight, returning embeddings in input order."""
+        batches = [
+            texts[i:i + EMBED_BATCH_SIZE]
+            for i in range(0, len(texts), EMBED_BATCH_SIZE)
+        ]
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+        async def sem_embed(batch_index: int, batch: List[str]):
+            async with sem:
+                result = await self._embed_with_retry(self.async_client, batch)
+            start = batch_index * EMBED_BATCH_SIZE
+            embeddings[start:start + len(result)] = result
+
+        await asyncio.gather(*[sem_embed(i, b) for i, b in enumerate(batches)])
+        return embeddings
+
+    async def _embed_with_retry(self, client, batch: List[str]) -> List[List[float]]:
+        for attempt in range(EMBED_MAX_RETRIES + 1):
+            try:
+                response = await client.embeddings.create(
+                    model=self.model_name,
+                    input=batch,
+                )
+                return [e.embedding for e in response.data]
+            except (openai.RateLimitError, openai.APIConnectionError,
+                    openai.InternalServerError) as e:
+                if attempt == EMBED_MAX_RETRIES:
+                    raise
+                # Full jitter so throttled batches don't retry in lockstep
+                delay = random.uniform(0, min(EMBED_MAX_BACKOFF, 0.5 * 2 ** attempt))
+                logger.warning(f"Embedding batch failed ({e.__class__.__name__}), "
+                               f"retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+def _ensure_pgvector_version(engine) -> None:
+    """Update the vector extension in place and check it is new enough.
+
+    Databases created from an older image keep their old extension version
+    even after the server is upgraded, until ALTER EXTENSION is run.
+    """
+    with engine.connect() as conn:
+        try:
+            conn.execute(text("ALTER EXTENSION vector UPDATE;"))
+            conn.commit()
+        except DBAPIError as e:
+            conn.rollback()
+            logger.warning(f"Could not update the vector extension: {e.orig}")
+        version = conn.execute(text(
+            "SELECT extversion FROM pg_extension WHERE extname = 'vector';"
+        )).scalar()
+
+    def as_tuple(v: str):
+        return tuple(int(part) for part in v.split(".")[:3] if part.isdigit())
+
+    if version is None or as_tuple(version) < as_tuple(PGVECTOR_MIN_VERSION):
+        raise RuntimeError(
+            f"pgvector {PGVECTOR_MIN_VERSION} or newer is required, but the database "
+            f"has {version or 'no vector extension'}. Use a newer server image "
+            f"(e.g. pgvector/pgvector:pg15) and run ALTER EXTENSION vector UPDATE."
+        )
+
+def _ensure_halfvec_embeddings(engine, dim: int) -> None:
+    """Store chunk embeddings as half-precision halfvec.
+
+    Halves the size of every stored vector, and with it the bytes read
+    when scanning for nearest neighbours.
+    """
+    with engine.connect() as conn:
+        column_type = conn.execute(text("""
+            SELECT format_type(atttypid, atttypmod)
+            FROM pg_attribute
+            WHERE attrelid = 'chunks'::regclass
+            AND attname = 'embedding';
+        """)).scalar()
+        if column_type != f"halfvec({dim})":
+            logger.info(f"Converting chunks.embedding from {column_type} to halfvec({dim})")
+            conn.execute(text(f"""
+                ALTER TABLE chunks
+                ALTER COLUMN embedding TYPE halfvec({dim})
+                USING embedding::halfvec({dim});
+            """))
+            conn.commit()
+
+def _ensure_hnsw_index(engine) -> None:
+    """Index chunk embeddings with HNSW for approximate cosine search."""
+    with engine.connect() as conn:
+        conn.execute(text(f"""
+            CREATE INDEX IF NOT EXISTS chunks_embed_hnsw ON chunks
+            USING hnsw (embedding halfvec_cosine_ops)
+            WITH (m = {HNSW_M}, ef_construction = {HNSW_EF_CONSTRUCTION});
+        """))
+        conn.commit()
+
+def _ensure_unique_file_content(engine) -> None:
+    """Allow each distinct file content (by crc) only once per project.
+
+    Projects that already hold duplicates keep them and the index is skipped
+    with a warning. With DEDUPE_FILES_ON_START=true the later copies are
+    deleted first, keeping the oldest row (min id) of each (project_id, crc);
+    their chunks go with them via ON DELETE CASCADE. Rows written before crcs
+    switched to xxh3 still carry MD5 digests, so re-uploading such a file is
+    not recognised as a duplicate.
+    """
+    with engine.connect() as conn:
+        try:
+            if DEDUPE_FILES_ON_START and conn.execute(
+                text("SELECT to_regclass('uix_files_project_crc');")
+            ).scalar() is None:
+                removed = conn.execute(text("""
+                    DELETE FROM files f
+                    USING files keep
+                    WHERE f.project_id = keep.project_id
+                      AND f.crc = keep.crc
+                      AND f.id > keep.id
+                    RETURNING f.id, f.filename, f.project_id;
+                """)).all()
+                for file_id, filename, project_id in removed:
+                    logger.warning(f"Removed duplicate file {filename} (ID: {file_id}) "
+                                   f"from project {project_id}")
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uix_files_project_crc
+                ON files (project_id, crc);
+            """))
+            conn.commit()
+        except IntegrityError:
+            conn.rollback()
+            logger.warning("Duplicate files share a crc within a project; remove them "
+                           "(or set DEDUPE_FILES_ON_START=true) to enable uix_files_project_crc")
+
+def _ensure_chunk_stats(engine) -> None:
+    """Store each chunk's character and line counts alongside its content.
+
+    Generated columns are computed once when a chunk is written, so results
+    can be shown without rescanning the text on every render.
+    """
+    with engine.connect() as conn:
+        conn.execute(text("""
+            ALTER TABLE chunks
+            ADD COLUMN IF NOT EXISTS content_size integer
+                GENERATED ALWAYS AS (char_length(content)) STORED,
+            ADD COLUMN IF NOT EXISTS line_count integer
+                GENERATED ALWAYS AS (
+                    char_length(content) - char_length(replace(content, E'\\n', '')) + 1
+                ) STORED;
+        """))
+        conn.commit()
+
+# Stored by _ensure_chunk_stats; vector_rag's ChunkDB doesn't map them
+CHUNK_CONTENT_SIZE = literal_column("chunks.content_size", Integer).label("content_size")
+CHUNK_LINE_COUNT = literal_column("chunks.line_count", Integer).label("line_count")
+
+@st.cache_data(ttl=3600, max_entries=1024, show_spinner=False)
+def _embed_query(_embedder: BatchEmbedder, text: str) -> List[float]:
+    """Embed a search query, cached so reruns with the same query skip OpenAI."""
+    return _embedder.embed_query(text)
+
+def _distinct_on(stmt, *columns):
+    """Apply DISTINCT ON; SQLAlchemy 2.1 deprecates passing columns to distinct()."""
+    if distinct_on is None:
+        return stmt.distinct(*columns)
+    return stmt.ext(distinct_on(*columns))
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_projects(_handler: DBFileHandler):
+    return _handler.get_projects()
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _cached_files(_handler: DBFileHandler, project_id: int) -> List[File]:
+    FileDB = _handler.File
+    with _handler.session_scope() as session:
+        # One row per (name, crc); duplicates are collapsed by the database
+        rows = session.execute(
+            _distinct_on(
+                select(FileDB.id, FileDB.filename, FileDB.file_path, FileDB.crc, FileDB.file_size)
+                .where(FileDB.project_id == project_id),
+                FileDB.filename, FileDB.crc,
+            )
+            .order_by(FileDB.filename, FileDB.crc, FileDB.id)
+        ).all()
+    return [
+        File(id=row.id, name=row.filename, path=row.file_path,
+             crc=row.crc, file_size=row.file_size)
+        for row in rows
+    ]
+
+def _rank_dense(embeddings: np.ndarray, groups: np.ndarray, query_embedding: List[float],
+                page: int, page_size: int, similarity_threshold: float):
+    """Rank unit-normalised embedding rows against a query.
+
+    Keeps the best scoring row per group, drops rows under the threshold and
+    returns (row positions for the requested page, all scores, total matches).
+    """
+    query_vec = np.asarray(query_embedding, dtype=np.float32)
+    query_vec /= np.linalg.norm(query_vec) or 1.0
+    # Rows are stored unit-normalised, so this is every cosine similarity
+    scores = embeddings @ query_vec
+    matches = np.flatnonzero(scores >= similarity_threshold)
+    # Keep only the best scoring row for each (content, index) pair
+    matches = matches[np.argsort(-scores[matches], kind="stable")]
+    _, best = np.unique(groups[matches], return_index=True)
+    matches = matches[best]
+
+    total_count = len(matches)
+    offset = (page - 1) * page_size
+    top = min(offset + page_size, total_count)
+    page_hits = np.empty(0, dtype=np.intp)
+    if top > offset:
+        top_hits = matches[np.argpartition(-scores[matches], top - 1)[:top]]
+        page_hits = top_hits[np.argsort(-scores[top_hits], kind="stable")][offset:]
+    return page_hits, scores, total_count
+
+# Streamlit sessions share the process; one writer per dense index directory
+_dense_index_locks = {}
+_dense_index_locks_guard = threading.Lock()
+
+def _dense_index_lock(index_dir: Path) -> threading.Lock:
+    with _dense_index_locks_guard:
+        return _dense_index_locks.setdefault(index_dir, threading.Lock())
+
+class SearchResults(ChunkResults):
+    """ChunkResults that can flag total_count as a lower bound.
+
+    The HNSW path only counts matches within its candidate window, so when
+    the window fills up there may be more matches than total_count.
+    """
+    count_is_lower_bound: bool = False
+
+
 class ProjectManager:
     def __init__(self):
         config = Config()
@@ -27,92 +370,481 @@ class ProjectManager:
     @staticmethod
     @st.cache_resource
     def _init_handler(_config: Config):
-        return DBFileHandler(_config, chunker=SizeChunker(_config))
+        handler = DBFileHandler(
+            _config,
+            embedder=BatchEmbedder(_config),
+            chunker=SizeChunker(_config)
+        )
+        _ensure_pgvector_version(handler.engine)
+        _ensure_halfvec_embeddings(handler.engine, handler.embedder.get_dimension())
+        _ensure_hnsw_index(handler.engine)
+        _ensure_unique_file_content(handler.engine)
+        _ensure_chunk_stats(handler.engine)
+        return handler
 
     def create_project(self, name: str, description: Optional[str] = None):
         if name:
             project = self.handler.create_project(name, description)
+            _cached_projects.clear()
             st.success(f"Created project: {project.name} (ID: {project.id})")
             return project
         return None
 
     def add_file_to_project(self, project_id: int, uploaded_file) -> bool:
-        # Check if file was already uploaded in this session
-        session_key = f"uploaded_{uploaded_file.name}_{project_id}"
-        if session_key in st.session_state:
-            logger.debug(f"File {uploaded_file.name} was already uploaded in this session")
-            return True
-
-        logger.debug(f"Processing new file upload: {uploaded_file.name}")
-        with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-            content = uploaded_file.getvalue()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
-
-        CHUNK_SIZE = int(os.getenv('CHUNK_SIZE', 255))
-        CHUNK_OVERLAP = int(os.getenv('CHUNK_OVERLAP', 25))
-        size_chunker = SizeChunker(self.config)
+        return self.add_files_to_project(project_id, [uploaded_file])
+
+    def add_files_to_project(self, project_id: int, uploaded_files) -> bool:
+        """Chunk all uploaded files and embed the chunks in shared batches.
+
+        Chunks from every file are buffered and sent to the embedder
+        EMBED_BATCH_SIZE at a time, so an upload costs
+        ceil(total_chunks / EMBED_BATCH_SIZE) embedding requests instead of
+        one per chunk. Up to EMBED_CONCURRENCY of those requests run at once.
+
+        Files are decoded and embedded before any transaction is opened, and
+        each file is inserted in its own transaction, so a file that is not
+        UTF-8 or fails to embed or insert is reported without losing the rest.
+        """
+        uploads = [(f, self._hash_upload(f)) for f in uploaded_files]
+        FileDB = self.handler.File
+        try:
+            with self.handler.session_scope() as session:
+                # Content already in the project is skipped before decoding or embedding
+                known_crcs = set(session.scalars(
+                    select(FileDB.crc)
+                    .where(FileDB.project_id == project_id)
+                    .where(FileDB.crc.in_([crc for _, crc in uploads]))
+                ))
+        except Exception as e:
+            logger.error(f"Error adding files to project {project_id}: {str(e)}", exc_info=True)
+            st.error(f"Failed to add files: {str(e)}")
+            return False
+
+        # The caller reruns the app after an upload, which would wipe anything
+        # shown here; render_file_upload shows these on the next run instead.
+        notices = st.session_state.setdefault("upload_notices", [])
+        prepared = []  # (file, meta_data, chunks) waiting for embeddings
+        for uploaded_file, crc in uploads:
+            if crc in known_crcs:
+                logger.debug(f"File {uploaded_file.name} content already in project")
+                notices.append(("info", f"Skipped {uploaded_file.name}: same content is already in this project"))
+                continue
+            known_crcs.add(crc)
+
+            logger.debug(f"Processing new file upload: {uploaded_file.name}")
+            try:
+                content = self._decode_upload(uploaded_file)
+            except UnicodeDecodeError:
+                logger.warning(f"File {uploaded_file.name} is not valid UTF-8")
+                notices.append(("error", f"Skipped {uploaded_file.name}: not a UTF-8 text file"))
+                continue
+            meta_data = {"type": uploaded_file.type}
+            try:
+                file = File(
+                    name=uploaded_file.name,
+                    path=uploaded_file.name,
+                    content=content,
+                    crc=crc,
+                    meta_data=meta_data
+                )
+                chunks = self.handler.chunker.chunk_text(file)
+            except Exception as e:
+                # e.g. a name longer than File allows
+                logger.error(f"Error preparing file {uploaded_file.name}: {str(e)}", exc_info=True)
+                notices.append(("error", f"Skipped {uploaded_file.name}: {str(e)}"))
+                continue
+            logger.debug(f"Chunked file: {file.name} into {len(chunks)} chunks")
+            prepared.append((file, meta_data, chunks))
+
+        added_names = []
+        for (file, meta_data, chunks), embeddings in zip(prepared, self._embed_files(prepared)):
+            try:
+                if isinstance(embeddings, Exception):
+                    raise embeddings
+                with self.handler.session_scope() as session:
+                    self._insert_file(session, project_id, file, meta_data, chunks, embeddings)
+            except Exception as e:
+                logger.error(f"Error adding file {file.name} to project {project_id}: {str(e)}", exc_info=True)
+                notices.append(("error", f"Failed to add {file.name}: {str(e)}"))
+                continue
+            logger.debug(f"Successfully added file: {file.name}")
+            added_names.append(file.name)
+            notices.append(("success", f"Added file: {file.name}"))
+
+        if added_names:
+            _cached_files.clear()
+        return True
+
+    @staticmethod
+    def _hash_upload(uploaded_file) -> str:
+        # Uploads are held in RAM; getbuffer() reads them without a bytes copy.
+        # Dedup key only, so a fast non-cryptographic hash is enough
+        with uploaded_file.getbuffer() as buf:
+            return xxhash.xxh3_128_hexdigest(buf)
+
+    @staticmethod
+    def _decode_upload(uploaded_file) -> str:
+        with uploaded_file.getbuffer() as buf:
+            return str(buf, 'utf-8')
+
+    def _embed_files(self, prepared) -> list:
+        """Embed the chunks of every prepared file, returning one list of
+        embeddings (or the exception raised) per file."""
+        texts = [chunk.content for _, _, chunks in prepared for chunk in chunks]
+        if not texts:
+            return [[] for _ in prepared]
+        logger.debug(f"Embedding {len(texts)} chunks")
         try:
-            file = File(
-                name=uploaded_file.name,
-                path=tmp_file_path,
-                content=content.decode('utf-8'),
-                crc=hashlib.md5(content).hexdigest(),
-                meta_data={"type": uploaded_file.type}
+            embeddings = self.handler.embedder.embed_batches(texts)
+        except TimeoutError as e:
+            # Not caused by any one file; retrying would only wait again
+            return [e for _ in prepared]
+        except Exception as e:
+            # Shared batches mix files; retry file by file to find the bad ones
+            logger.warning(f"Batch embedding failed, retrying per file: {str(e)}")
+            results = []
+            for _, _, chunks in prepared:
+                try:
+                    results.append(self.handler.embedder.embed_batches([c.content for c in chunks]))
+                except Exception as file_error:
+                    results.append(file_error)
+            return results
+
+        results = []
+        offset = 0
+        for _, _, chunks in prepared:
+            results.append(embeddings[offset:offset + len(chunks)])
+            offset += len(chunks)
+        return results
+
+    def _insert_file(self, session, project_id: int, file: File, meta_data, chunks, embeddings) -> None:
+        file_db = self.handler.File(
+            project_id=project_id,
+            filename=file.name,
+            file_path=file.path,
+            crc=file.crc,
+            file_size=file.size,
+        )
+        session.add(file_db)
+        session.flush()  # Get file_db.id
+        session.add_all([
+            self.handler.Chunk(
+                file_id=file_db.id,
+                content=chunk.content,
+                embedding=embedding,
+                chunk_index=chunk.index,
+                chunk_metadata=meta_data,
             )
-            logger.debug(f"Adding file: {file.name} to project: {project_id}")
-            debug_chunker(size_chunker, file)
-            logger.debug(f"Debug Chunk done. Chunking file: {file.name}")
-            result = self.handler.add_file(project_id, file)
-            if result:
-                logger.debug(f"Successfully added file: {result.name}")
-                st.success(f"Added file: {result.name}")
-                # Mark file as uploaded in this session
-                st.session_state[session_key] = True
-                return True
-            else:
-                logger.error("Failed to add file to database")
-                st.error("Failed to add file")
-                return False
-        finally:
-            os.unlink(tmp_file_path)
+            for chunk, embedding in zip(chunks, embeddings)
+        ])
 
     def remove_file_from_project(self, project_id: int, file_id: int) -> bool:
+        return self.remove_files_from_project(project_id, [file_id])
+
+    def remove_files_from_project(self, project_id: int, file_ids: List[int]) -> bool:
         try:
-            logger.debug(f"Attempting to remove file with ID: {file_id} from project: {project_id}")
-            result = self.handler.delete_file(file_id)
-            logger.debug(f"Delete file result: {result}")
-            
-            if result:
-                st.success(f"Removed file with ID: {file_id}")
-                st.session_state.files_changed = True
-                logger.debug("Set files_changed flag to True")
+            logger.debug(f"Attempting to remove files with IDs: {file_ids} from project: {project_id}")
+            FileDB = self.handler.File
+            with self.handler.session_scope() as session:
+                # One statement for any number of files; a single array parameter
+                # keeps the SQL text identical whatever the selection size.
+                # Chunks are removed by the chunks.file_id ON DELETE CASCADE.
+                removed = session.execute(
+                    delete(FileDB)
+                    .where(FileDB.project_id == project_id)
+                    .where(FileDB.id == any_(bindparam("file_ids", file_ids, type_=ARRAY(Integer))))
+                    .returning(FileDB.id)
+                    .execution_options(synchronize_session=False)
+                ).scalars().all()
+            logger.debug(f"Removed file IDs: {removed}")
+
+            if removed:
+                _cached_files.clear()
+            missing = [file_id for file_id in file_ids if file_id not in removed]
+            if not missing:
+                st.success(f"Removed files with IDs: {', '.join(map(str, removed))}")
                 return True
             else:
-                st.error(f"Failed to remove file with ID: {file_id}")
+                st.error(f"Failed to remove files with IDs: {', '.join(map(str, missing))}")
                 return False
         except Exception as e:
-            logger.error(f"Error removing file: {str(e)}", exc_info=True)
-            st.error(f"Error removing file: {str(e)}")
+            logger.error(f"Error removing files: {str(e)}", exc_info=True)
+            st.error(f"Error removing files: {str(e)}")
             return False
 
     def search_project(self, project_id: int, query: str, page: int, 
-                      page_size: int, similarity_threshold: float):
-        results = self.handler.search_chunks_by_text(
-            project_id=project_id,
-            query_text=query,
+                      page_size: int, similarity_threshold: float,
+                      use_dense: bool = DENSE_SEARCH):
+        # Normalize whitespace so trivially different queries share a cache entry
+        query_embedding = _embed_query(self.handler.embedder, " ".join(query.split()))
+        if use_dense:
+            results = self._search_dense(
+                project_id, query_embedding, page, page_size, similarity_threshold
+            )
+            if results is not None:
+                return results
+
+        ChunkDB, FileDB = self.handler.Chunk, self.handler.File
+        # Compare halfvec to halfvec so the column type's operators and indexes apply
+        query_vector = cast(query_embedding, HALFVEC(self.handler.embedder.get_dimension()))
+        distance = ChunkDB.embedding.cosine_distance(query_vector)
+
+        candidate_limit = max(SEARCH_CANDIDATES, page * page_size)
+        with self.handler.session_scope() as session:
+            session.execute(text(f"SET LOCAL hnsw.ef_search = {HNSW_EF_SEARCH}"))
+            # The project filter discards index hits; keep scanning in distance order
+            session.execute(text("SET LOCAL hnsw.iterative_scan = strict_order"))
+            # ORDER BY distance LIMIT n is the only shape the HNSW index can serve,
+            # so threshold, dedup and paging are applied to this candidate set
+            candidates = (
+                select(
+                    ChunkDB.content,
+                    ChunkDB.chunk_index,
+                    ChunkDB.chunk_metadata,
+                    CHUNK_CONTENT_SIZE,
+                    CHUNK_LINE_COUNT,
+                    (literal(1.0, type_=Float) - distance).label("similarity"),
+                )
+                .join(FileDB)
+                .where(FileDB.project_id == project_id)
+                .order_by(distance)
+                .limit(candidate_limit)
+                .cte("candidates")
+            )
+            # Keep only the best scoring row for each (content, index) pair
+            unique_chunks = (
+                _distinct_on(
+                    select(candidates)
+                    .where(candidates.c.similarity >= literal(similarity_threshold, type_=Float)),
+                    candidates.c.content, candidates.c.chunk_index,
+                )
+                .order_by(
+                    candidates.c.content,
+                    candidates.c.chunk_index,
+                    candidates.c.similarity.desc(),
+                )
+                .subquery()
+            )
+            total_count, candidate_count, min_similarity = session.execute(
+                select(
+                    select(func.count()).select_from(unique_chunks).scalar_subquery(),
+                    select(func.count()).select_from(candidates).scalar_subquery(),
+                    select(func.min(candidates.c.similarity)).scalar_subquery(),
+                )
+            ).one()
+            rows = session.execute(
+                select(unique_chunks)
+                .order_by(unique_chunks.c.similarity.desc())
+                .offset((page - 1) * page_size)
+                .limit(page_size)
+            ).all()
+
+        results = self._chunk_results(
+            [(row, row.similarity) for row in rows], total_count or 0, page, page_size
+        )
+        # Candidates come in distance order, so matches can lie beyond the
+        # window only if it is full and its farthest row still passes
+        results.count_is_lower_bound = (
+            candidate_count >= candidate_limit
+            and min_similarity is not None
+            and min_similarity >= similarity_threshold
+        )
+        return results
+
+    def _search_dense(self, project_id: int, query_embedding: List[float], page: int,
+                      page_size: int, similarity_threshold: float) -> Optional[ChunkResults]:
+        """Score every chunk of the project with one matrix-vector product.
+
+        Returns None when the project is too large for brute force, so the
+        caller falls back to the HNSW index.
+        """
+        index = self._load_dense_index(project_id)
+        if index is None:
+            return None
+        embeddings, chunk_ids, groups = index
+        page_hits, scores, total_count = _rank_dense(
+            embeddings, groups, query_embedding, page, page_size, similarity_threshold
+        )
+
+        ChunkDB = self.handler.Chunk
+        with self.handler.session_scope() as session:
+            rows = session.execute(
+                select(ChunkDB.id, ChunkDB.content, ChunkDB.chunk_index, ChunkDB.chunk_metadata,
+                       CHUNK_CONTENT_SIZE, CHUNK_LINE_COUNT)
+                .where(ChunkDB.id.in_(chunk_ids[page_hits].tolist()))
+            ).all()
+        rows_by_id = {row.id: row for row in rows}
+        return self._chunk_results(
+            [
+                (rows_by_id[chunk_id], scores[hit])
+                for hit, chunk_id in zip(page_hits, chunk_ids[page_hits])
+                if chunk_id in rows_by_id
+            ],
+            total_count, page, page_size
+        )
+
+    @staticmethod
+    def _chunk_results(scored_rows, total_count: int, page: int, page_size: int) -> SearchResults:
+        return SearchResults(
+            results=[
+                ChunkResult(
+                    # Guard against float rounding just outside [0, 1]
+                    score=min(max(float(score), 0.0), 1.0),
+                    chunk=Chunk(
+                        target_size=1,
+                        content=row.content,
+                        index=row.chunk_index,
+                        meta_data=row.chunk_metadata,
+                        content_size=row.content_size,
+                        line_count=row.line_count,
+                    ),
+                )
+                for row, score in scored_rows
+            ],
+            total_count=total_count,
             page=page,
             page_size=page_size,
-            similarity_threshold=similarity_threshold
         )
-        return results
+
+    def _dense_index_dir(self, project_id: int) -> Path:
+        return DENSE_INDEX_DIR / self.config.DB_NAME / f"project_{project_id}"
+
+    def _load_dense_index(self, project_id: int):
+        """Return (embeddings, chunk_ids, groups) for the project, or None when
+        it is too large for brute force.
+
+        The arrays on disk carry a fingerprint of the chunk count, highest
+        chunk id and embedding dimension. One count/max query decides whether
+        they are current, can be brought up to date by appending newer chunks,
+        or must be rebuilt. That also covers writes from other sessions,
+        processes and recreated databases.
+        """
+        ChunkDB, FileDB = self.handler.Chunk, self.handler.File
+        with self.handler.session_scope() as session:
+            chunk_count, max_id = session.execute(
+                select(func.count(ChunkDB.id), func.coalesce(func.max(ChunkDB.id), 0))
+                .join(FileDB)
+                .where(FileDB.project_id == project_id)
+            ).one()
+        if chunk_count > DENSE_SEARCH_MAX_CHUNKS:
+            logger.debug(f"Project {project_id} has {chunk_count} chunks, "
+                         f"skipping dense index")
+            return None
+        index_dir = self._dense_index_dir(project_id)
+        # Sessions searching a stale project wait for one rebuild and then
+        # find it current, instead of writing the same files concurrently
+        with _dense_index_lock(index_dir):
+            return self._sync_dense_index(project_id, index_dir, chunk_count, max_id)
+
+    def _sync_dense_index(self, project_id: int, index_dir: Path, chunk_count: int, max_id: int):
+        dim = self.handler.embedder.get_dimension()
+        try:
+            stored_count, stored_max_id, stored_dim = np.load(index_dir / "fingerprint.npy")
+            embeddings = np.load(index_dir / "embeddings.npy", mmap_mode="r")
+            chunk_ids = np.load(index_dir / "chunk_ids.npy")
+            groups = np.load(index_dir / "groups.npy")
+        except (FileNotFoundError, ValueError):
+            return self._build_dense_index(project_id)
+        if not len(embeddings) == len(chunk_ids) == len(groups) == stored_count:
+            # Caught another session halfway through writing the index
+            return self._build_dense_index(project_id)
+        if stored_dim != dim or stored_max_id > max_id:
+            return self._build_dense_index(project_id)
+        if (stored_count, stored_max_id) == (chunk_count, max_id):
+            return embeddings, chunk_ids, groups
+
+        # Uploads only add chunks with higher ids; anything else (removals)
+        # shows up as a count mismatch and needs a full rebuild
+        new_ids, new_embeddings, new_groups = self._fetch_dense_rows(
+            project_id, after_id=int(stored_max_id)
+        )
+        if stored_count + len(new_ids) != chunk_count:
+            return self._build_dense_index(project_id)
+        logger.debug(f"Appending {len(new_ids)} chunks to dense index for project {project_id}")
+        return self._save_dense_index(
+            index_dir,
+            (embeddings, new_embeddings),
+            np.concatenate([chunk_ids, new_ids]),
+            np.concatenate([groups, new_groups]),
+        )
+
+    def _build_dense_index(self, project_id: int):
+        chunk_ids, embeddings, groups = self._fetch_dense_rows(project_id)
+        logger.debug(f"Building dense index for project {project_id} ({len(chunk_ids)} chunks)")
+        return self._save_dense_index(
+            self._dense_index_dir(project_id), (embeddings,), chunk_ids, groups
+        )
+
+    def _fetch_dense_rows(self, project_id: int, after_id: int = 0):
+        ChunkDB, FileDB = self.handler.Chunk, self.handler.File
+        with self.handler.session_scope() as session:
+            rows = session.execute(
+                select(
+                    ChunkDB.id,
+                    ChunkDB.embedding,
+                    # Rows sharing (content, index) share a group for dedup; a
+                    # per-row hash keeps groups stable when rows are appended
+                    func.hashtextextended(ChunkDB.content, ChunkDB.chunk_index).label("group"),
+                )
+                .join(FileDB)
+                .where(FileDB.project_id == project_id)
+                .where(ChunkDB.id > after_id)
+                .order_by(ChunkDB.id)
+            ).all()
+
+        dim = self.handler.embedder.get_dimension()
+        embeddings = np.array([row.embedding for row in rows], dtype=np.float32).reshape(-1, dim)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+        chunk_ids = np.array([row.id for row in rows], dtype=np.int64)
+        groups = np.array([row.group for row in rows], dtype=np.int64)
+        return chunk_ids, embeddings, groups
+
+    def _save_dense_index(self, index_dir: Path, embedding_parts, chunk_ids, groups):
+        index_dir.mkdir(parents=True, exist_ok=True)
+        dim = self.handler.embedder.get_dimension()
+        # Written through a memmap so appending never holds old and new
+        # matrices on the heap at the same time
+        tmp_path = self._dense_tmp_path(index_dir)
+        out = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float32, shape=(len(chunk_ids), dim)
+        )
+        start = 0
+        for part in embedding_parts:
+            out[start:start + len(part)] = part
+            start += len(part)
+        out.flush()
+        del out
+        # Mapped before the rename, so the result is this writer's file even
+        # if another process replaces embeddings.npy right after
+        embeddings = np.load(tmp_path, mmap_mode="r")
+
+        fingerprint = np.array(
+            [len(chunk_ids), chunk_ids.max(initial=0), dim], dtype=np.int64
+        )
+        os.replace(tmp_path, index_dir / "embeddings.npy")
+        # The fingerprint goes last so it never describes arrays not yet written
+        for name, array in (("chunk_ids", chunk_ids), ("groups", groups),
+                            ("fingerprint", fingerprint)):
+            tmp_path = self._dense_tmp_path(index_dir)
+            np.save(tmp_path, array)
+            os.replace(tmp_path, index_dir / f"{name}.npy")
+        return embeddings, chunk_ids, groups
+
+    @staticmethod
+    def _dense_tmp_path(index_dir: Path) -> Path:
+        # A unique name per write; other processes may share the directory
+        fd, path = tempfile.mkstemp(dir=index_dir, suffix=".npy")
+        os.close(fd)
+        return Path(path)
 
     def get_projects(self):
-        return self.handler.get_projects()
+        return _cached_projects(self.handler)
 
     def list_project_files(self, project_id: int):
         logger.debug(f"Fetching files for project: {project_id}")
-        files = self.handler.list_files(project_id)
+        files = _cached_files(self.handler, project_id)
         logger.debug(f"Found {len(files)} files")
         return files
 
@@ -131,19 +863,27 @@ class UI:
 
     def render_file_upload(self, project_id: int):
         st.subheader("Add File")
-        
+
+        for kind, message in st.session_state.pop("upload_notices", []):
+            getattr(st, kind)(message)
+
         # Clear file uploader if upload was successful
         if "last_uploaded_file" in st.session_state and st.session_state.last_uploaded_file:
             st.session_state.last_uploaded_file = None
             return
 
-        uploaded_file = st.file_uploader("Choose a file", key=f"file_upload_{project_id}")
-        if uploaded_file is not None:
-            logger.debug(f"File selected: {uploaded_file.name}")
-            if self.project_manager.add_file_to_project(project_id, uploaded_file):
-                st.session_state.last_uploaded_file = uploaded_file
+        uploaded_files = st.file_uploader(
+            "Choose files",
+            accept_multiple_files=True,
+            key=f"file_upload_{project_id}"
+        )
+        if uploaded_files:
+            logger.debug(f"Files selected: {[f.name for f in uploaded_files]}")
+            if self.project_manager.add_files_to_project(project_id, uploaded_files):
+                st.session_state.last_uploaded_file = uploaded_files
                 st.rerun()
 
+    @st.fragment
     def render_file_list(self, project_id: int):
         st.subheader("Project Files")
         logger.debug(f"Rendering file list for project: {project_id}")
@@ -153,50 +893,41 @@ class UI:
             st.info("No files in this project")
             return
 
-        # Create a dictionary to deduplicate files by their name and content hash
-        unique_files = {}
-        for file in files:
-            file_key = f"{file.name}_{file.crc}"  # Using name and CRC as unique identifier
-            if file_key not in unique_files:
-                unique_files[file_key] = file
-        
-        logger.debug(f"Number of unique files: {len(unique_files)}")
-
-        # Initialize session state for files_changed if not exists
-        if 'files_changed' not in st.session_state:
-            st.session_state.files_changed = False
-            logger.debug("Initialized files_changed session state")
-
-        for file in unique_files.values():
-            col_info, col_remove = st.columns([3, 1])
-            with col_info:
-                st.write(f"File: {file.name} (ID: {file.id})")
-            with col_remove:
-                button_key = f"remove_{file.id}_{file.crc}"
-                logger.debug(f"Button key: {button_key}")
-                if st.button("Remove", key=button_key):
-                    logger.debug(f"Remove button clicked for file: {file.name} (ID: {file.id})")
-                    if self.project_manager.remove_file_from_project(project_id, file.id):
-                        logger.debug("File removal successful, triggering rerun")
-                        st.session_state.files_changed = True
-                        st.rerun()
-                    else:
-                        logger.debug("File removal failed")
-        
-        # Check if files have changed and rerun if needed
-        if st.session_state.files_changed:
-            logger.debug("Files changed flag detected, triggering rerun")
-            st.session_state.files_changed = False
-            st.rerun()
+        # One dataframe with row selection instead of a row of widgets per file
+        file_table = pd.DataFrame([{"name": file.name, "id": file.id} for file in files])
+        event = st.dataframe(
+            file_table,
+            hide_index=True,
+            on_select="rerun",
+            selection_mode="multi-row",
+            # Selections are stored as row positions; keying on the listed ids
+            # drops a selection as soon as the rows underneath it change
+            key=f"file_table_{project_id}_{hash(tuple(file_table['id']))}"
+        )
+        rows = [row for row in event.selection.rows if 0 <= row < len(file_table)]
+        selected_ids = file_table["id"].iloc[rows].tolist()
+        if st.button("Remove selected", disabled=not selected_ids, key=f"remove_files_{project_id}"):
+            logger.debug(f"Remove button clicked for file IDs: {selected_ids}")
+            if self.project_manager.remove_files_from_project(project_id, selected_ids):
+                logger.debug("File removal successful, rerunning file list")
+                # Only the file list changed; leave the rest of the page alone
+                st.rerun(scope="fragment")
+            else:
+                logger.debug("File removal failed")
 
+    @st.fragment
     def render_search_interface(self, project_id: int):
         st.header("Search Documents")
-        search_query = st.text_input("Enter your search query")
-        similarity_threshold = st.slider("Similarity Threshold", 0.0, 1.0, 0.7, 0.05)
-        page_size = st.number_input("Results per page", min_value=1, value=10)
-        page = st.number_input("Page", min_value=1, value=1)
-        
-        if st.button("Search") and search_query:
+        # Inputs inside a form only rerun the script on submit, so adjusting
+        # the slider or page numbers doesn't hit the database on every change
+        with st.form("search_form"):
+            search_query = st.text_input("Enter your search query")
+            similarity_threshold = st.slider("Similarity Threshold", 0.0, 1.0, 0.7, 0.05)
+            page_size = st.number_input("Results per page", min_value=1, value=10)
+            page = st.number_input("Page", min_value=1, value=1)
+            submitted = st.form_submit_button("Search")
+
+        if submitted and search_query:
             results = self.project_manager.search_project(
                 project_id, search_query, page, page_size, similarity_threshold
             )
@@ -207,21 +938,18 @@ class UI:
             st.info("No matching results found.")
             return
 
-        st.write(f"Found {results.total_count} matching chunks")
+        if getattr(results, "count_is_lower_bound", False):
+            st.write(f"Found at least {results.total_count} matching chunks")
+        else:
+            st.write(f"Found {results.total_count} matching chunks")
         st.write(f"Page {results.page} of {results.total_pages}")
         
-        # Create a dictionary to deduplicate chunks based on content and index
-        unique_chunks = {}
         for chunk_result in results.results:
-            chunk_key = f"{chunk_result.chunk.content}_{chunk_result.chunk.index}"
-            if chunk_key not in unique_chunks or chunk_result.score > unique_chunks[chunk_key].score:
-                unique_chunks[chunk_key] = chunk_result
-
-        for chunk_result in unique_chunks.values():
             with st.expander(f"Score: {chunk_result.score:.3f}"):
                 st.text(chunk_result.chunk.content)
                 st.write(f"Chunk Index: {chunk_result.chunk.index}")
-                st.write(f"Chunk Size: {chunk_result.chunk.size} characters")
+                st.write(f"Chunk Size: {chunk_result.chunk.content_size} characters, "
+                         f"{chunk_result.chunk.line_count} lines")
                 if chunk_result.chunk.meta_data:
                     st.write("Metadata:")
                     for key, value in chunk_result.chunk.meta_data.items():
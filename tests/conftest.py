@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The app is run as a script (streamlit run src/app.py), not installed
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
@@ -0,0 +1,176 @@
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import app
+from vector_rag.db.db_model import ChunkDB, FileDB
+
+
+def brute_force(embeddings, groups, query, page, page_size, threshold):
+    query = np.asarray(query, dtype=np.float32)
+    scores = embeddings @ (query / np.linalg.norm(query))
+    best = {}
+    for i, score in enumerate(scores):
+        if score >= threshold and (groups[i] not in best or score > scores[best[groups[i]]]):
+            best[groups[i]] = i
+    ranked = sorted(best.values(), key=lambda i: -scores[i])
+    offset = (page - 1) * page_size
+    return ranked[offset:offset + page_size], len(ranked)
+
+
+@pytest.fixture
+def corpus():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(500, 8)).astype(np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    groups = rng.integers(0, 300, size=500)
+    return embeddings, groups, rng.normal(size=8).tolist()
+
+
+@pytest.mark.parametrize("page,page_size,threshold", [
+    (1, 10, 0.0), (2, 5, 0.1), (3, 7, -1.0), (1, 1000, 0.2),
+])
+def test_rank_dense_matches_brute_force(corpus, page, page_size, threshold):
+    embeddings, groups, query = corpus
+    page_hits, _, total_count = app._rank_dense(
+        embeddings, groups, query, page, page_size, threshold
+    )
+    expected, expected_total = brute_force(embeddings, groups, query, page, page_size, threshold)
+    assert total_count == expected_total
+    assert page_hits.tolist() == expected
+
+
+def test_rank_dense_keeps_best_row_per_group():
+    embeddings = np.array([[1.0, 0.0], [0.6, 0.8], [0.0, 1.0]], dtype=np.float32)
+    groups = np.array([7, 7, 9])
+    page_hits, scores, total_count = app._rank_dense(embeddings, groups, [1.0, 0.0], 1, 10, -1.0)
+    assert total_count == 2
+    assert page_hits.tolist() == [0, 2]
+    assert scores[0] == pytest.approx(1.0)
+
+
+def test_rank_dense_page_past_end(corpus):
+    embeddings, groups, query = corpus
+    page_hits, _, total_count = app._rank_dense(embeddings, groups, query, 100, 10, 0.0)
+    assert total_count > 0
+    assert len(page_hits) == 0
+
+
+def test_rank_dense_threshold_excludes_everything(corpus):
+    embeddings, groups, query = corpus
+    page_hits, _, total_count = app._rank_dense(embeddings, groups, query, 1, 10, 1.1)
+    assert total_count == 0
+    assert len(page_hits) == 0
+
+
+class FakeDB:
+    """Chunks of one project; answers the count/max fingerprint query."""
+
+    def __init__(self):
+        self.rows = {}  # chunk id -> (embedding, group)
+
+    def add(self, chunk_id, embedding, group):
+        self.rows[chunk_id] = (np.asarray(embedding, dtype=np.float32), group)
+
+    @contextlib.contextmanager
+    def session_scope(self):
+        count, max_id = len(self.rows), max(self.rows, default=0)
+        yield SimpleNamespace(
+            execute=lambda query: SimpleNamespace(one=lambda: (count, max_id))
+        )
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DENSE_INDEX_DIR", tmp_path)
+    db = FakeDB()
+    pm = app.ProjectManager.__new__(app.ProjectManager)
+    pm.config = SimpleNamespace(DB_NAME="test")
+    pm.handler = SimpleNamespace(
+        Chunk=ChunkDB,
+        File=FileDB,
+        session_scope=db.session_scope,
+        embedder=SimpleNamespace(get_dimension=lambda: 2),
+    )
+    fetches = []
+
+    def fetch_dense_rows(project_id, after_id=0):
+        fetches.append(after_id)
+        ids = sorted(i for i in db.rows if i > after_id)
+        embeddings = np.array([db.rows[i][0] for i in ids], dtype=np.float32).reshape(-1, 2)
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        groups = np.array([db.rows[i][1] for i in ids], dtype=np.int64)
+        return np.array(ids, dtype=np.int64), embeddings, groups
+
+    pm._fetch_dense_rows = fetch_dense_rows
+    return pm, db, fetches
+
+
+def test_dense_index_reused_appended_and_rebuilt(manager):
+    pm, db, fetches = manager
+    db.add(1, [1.0, 0.0], 1)
+    db.add(2, [0.0, 2.0], 2)
+
+    _, chunk_ids, _ = pm._load_dense_index(5)
+    assert chunk_ids.tolist() == [1, 2] and fetches == [0]
+
+    # Unchanged project: served from disk without fetching embeddings
+    pm._load_dense_index(5)
+    assert fetches == [0]
+
+    # New chunks are appended, fetching only rows past the stored max id
+    db.add(3, [3.0, 4.0], 3)
+    embeddings, chunk_ids, groups = pm._load_dense_index(5)
+    assert fetches == [0, 2]
+    assert chunk_ids.tolist() == [1, 2, 3] and groups.tolist() == [1, 2, 3]
+    np.testing.assert_allclose(embeddings[2], [0.6, 0.8])
+
+    # A removal changes the count and forces a full rebuild
+    del db.rows[1]
+    _, chunk_ids, _ = pm._load_dense_index(5)
+    assert fetches[-1] == 0
+    assert chunk_ids.tolist() == [2, 3]
+
+
+def test_dense_index_skipped_for_large_projects(manager, monkeypatch):
+    pm, db, fetches = manager
+    monkeypatch.setattr(app, "DENSE_SEARCH_MAX_CHUNKS", 1)
+    db.add(1, [1.0, 0.0], 1)
+    db.add(2, [0.0, 1.0], 2)
+    assert pm._load_dense_index(5) is None
+    assert fetches == []
+
+
+def test_concurrent_loads_build_once(manager):
+    pm, db, fetches = manager
+    for i in range(1, 51):
+        db.add(i, [float(i), 1.0], i)
+    fetch = pm._fetch_dense_rows
+    both_started = threading.Barrier(2)
+
+    def slow_fetch(project_id, after_id=0):
+        time.sleep(0.05)  # widen the window where both sessions see a stale index
+        return fetch(project_id, after_id)
+
+    pm._fetch_dense_rows = slow_fetch
+
+    def search():
+        both_started.wait()
+        return pm._load_dense_index(5)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        results = [f.result() for f in [pool.submit(search) for _ in range(2)]]
+
+    assert fetches == [0]
+    for embeddings, chunk_ids, _ in results:
+        assert chunk_ids.tolist() == list(range(1, 51))
+        assert embeddings.shape == (50, 2)
+    index_dir = pm._dense_index_dir(5)
+    assert sorted(p.name for p in index_dir.iterdir()) == [
+        "chunk_ids.npy", "embeddings.npy", "fingerprint.npy", "groups.npy",
+    ]